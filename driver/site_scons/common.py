@@ -5,11 +5,41 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+import functools
 import os
 import SCons.Script
+import SCons.Variables.BoolVariable as BoolVariable
 import SCons.Variables.PathVariable as PathVariable
 
 
+# Developer build options, which are only present in a developer checkout
+_DEV_OPTIONS_FILE = os.path.join('..', 'internal', 'dev_options.py')
+
+# The variables added by create_variables(), which only need to be constructed once
+_COMMON_VARIABLES = (
+    ('options', 'Options for SConstruct e.g. debug=0', 'options.py'),
+    ('PATH', 'Prepend to the PATH environment variable'),
+    ('LD_LIBRARY_PATH', 'Prepend to the LD_LIBRARY_PATH environment variable'),
+    ('CPATH', 'Append to the C include path list the compiler uses'),
+    ('LPATH', 'Append to the library path list the compiler uses'),
+
+    ('scons_extra', 'Extra scons files to be loaded, separated by comma.', ''),
+    ('scons_cache_dir', 'Directory for the SCons shared build cache. Caching is disabled if empty',
+     os.environ.get('ETHOSN_SCONS_CACHE_DIR', os.environ.get('SCONS_CACHE_DIR', ''))),
+    BoolVariable('use_ccache', 'Wrap the C/C++ compilers with ccache, if it is found on the PATH. '
+                 'The cache location is taken from the CCACHE_DIR environment variable.', False),
+
+    PathVariable('install_prefix', 'Installation prefix', os.path.join(os.path.sep, 'usr', 'local'),
+                 PathVariable.PathAccept),
+    PathVariable('install_bin_dir', 'Executables installation directory', os.path.join('$install_prefix', 'bin'),
+                 PathVariable.PathAccept),
+    PathVariable('install_include_dir', 'Header files installation directory',
+                 os.path.join('$install_prefix', 'include'), PathVariable.PathAccept),
+    PathVariable('install_lib_dir', 'Libraries installation directory', os.path.join('$install_prefix', 'lib'),
+                 PathVariable.PathAccept),
+)
+
+
 def create_variables():
     '''
     Create a default scons var setup.
@@ -21,43 +51,27 @@ def create_variables():
     Returns:
         (SCons.Script.Variables): The scons Variables pre-setup with common parameters
     '''
-    # First create a dummy env to parse just the 'options' parameter.
+    # First read just the 'options' parameter from the command line.
     # This allows the user to specify a file containing build options
-    options_var = SCons.Script.Variables()
-    options_var.Add('options', 'Options for SConstruct e.g. debug=0', 'options.py')
-    env = SCons.Script.Environment(variables=options_var)
+    options_file = SCons.Script.ARGUMENTS.get('options', 'options.py')
 
     # Use this parameter to create the real variables, pre-populating the values from the user provided
     # options file, and also the dev_options.py file, which may be pe present if this is a developer checkout.
+    # Files which don't exist are left out, so scons doesn't need to look for them again.
     # Note we include the 'options' var again, so it appears in the help command
-    var = SCons.Script.Variables([os.path.join('..', 'internal', 'dev_options.py'), env['options']])
-    var.AddVariables(
-        ('options', 'Options for SConstruct e.g. debug=0', 'options.py'),
-        ('PATH', 'Prepend to the PATH environment variable'),
-        ('LD_LIBRARY_PATH', 'Prepend to the LD_LIBRARY_PATH environment variable'),
-        ('CPATH', 'Append to the C include path list the compiler uses'),
-        ('LPATH', 'Append to the library path list the compiler uses'),
-
-        ('scons_extra', 'Extra scons files to be loaded, separated by comma.', ''),
-
-        PathVariable('install_prefix', 'Installation prefix', os.path.join(os.path.sep, 'usr', 'local'),
-                     PathVariable.PathAccept),
-        PathVariable('install_bin_dir', 'Executables installation directory', os.path.join('$install_prefix', 'bin'),
-                     PathVariable.PathAccept),
-        PathVariable('install_include_dir', 'Header files installation directory',
-                     os.path.join('$install_prefix', 'include'), PathVariable.PathAccept),
-        PathVariable('install_lib_dir', 'Libraries installation directory', os.path.join('$install_prefix', 'lib'),
-                     PathVariable.PathAccept),
-    )
+    option_files = [f for f in (_DEV_OPTIONS_FILE, options_file) if os.path.isfile(f)]
+    var = SCons.Script.Variables(option_files)
+    var.AddVariables(*_COMMON_VARIABLES)
     return var
 
 
 def load_extras(env):
     "Load any extra scons scripts, specified in scons_extra variable"
     scriptpath = env.get('scons_extra')
-    if scriptpath:
-        scripts = [s for s in scriptpath.split(',') if s]  # Ignore empty entries
-        for s in scripts:
+    if not scriptpath:
+        return
+    for s in scriptpath.split(','):
+        if s:  # Ignore empty entries
             env.SConscript(s, exports=['env'])
 
 
@@ -69,8 +83,24 @@ def add_env_var(env, variable):
         env (SCons.Environment): The scons environment to use
         variable          (str): The scons parameter to promote to an envvar
     '''
-    if variable in env:
-        env['ENV'][variable] = env[variable]
+    add_env_vars(env, (variable,))
+
+
+def add_env_vars(env, variables):
+    '''
+    Add scons variables into the scons environment as environment variables, but only those that have been set.
+
+    Args:
+        env (SCons.Environment): The scons environment to use
+        variables  (list/tuple): The scons parameters to promote to envvars
+    '''
+    env_vars = env['ENV']
+    for variable in variables:
+        if variable in env:
+            env_vars[variable] = env[variable]
+
+
+_IMPORTED_ENV_VARS = ('ARMLMD_LICENSE_FILE', 'TERM', 'PROCESSOR_ARCHITECTURE', 'PYTHONUNBUFFERED', 'CCACHE_DIR')
 
 
 def parse_default_vars(env):
@@ -80,33 +110,37 @@ def parse_default_vars(env):
     Args:
         env (SCons.Environment): The scons environment to use
     '''
-    # Import the ARMLMD_LICENSE_FILE environment variable into scons.
-    if 'ARMLMD_LICENSE_FILE' in os.environ:
-        env['ENV']['ARMLMD_LICENSE_FILE'] = os.environ['ARMLMD_LICENSE_FILE']
-    # Allows colours to be used e.g. for errors
-    if 'TERM' in os.environ:
-        env['ENV']['TERM'] = os.environ['TERM']
-    # Allow processes launched by scons to detect the processor architecture.
-    if 'PROCESSOR_ARCHITECTURE' in os.environ:
-        env['ENV']['PROCESSOR_ARCHITECTURE'] = os.environ['PROCESSOR_ARCHITECTURE']
-    # Allow python processes launched by scons to honour PYTHONUNBUFFERED.
-    # I think a better way of handling this would be to have each script set this itself
-    # if that script is launching subprocesses, but I haven't found a good way of doing this.
-    if 'PYTHONUNBUFFERED' in os.environ:
-        env['ENV']['PYTHONUNBUFFERED'] = os.environ['PYTHONUNBUFFERED']
-    # Prepend to the PATH env additional paths to search
-    if 'PATH' in env:
-        env.PrependENVPath('PATH', env['PATH'])
-    # Prepend to the LD_LIBRARY_PATH env additional paths to search when executing through scons
-    if 'LD_LIBRARY_PATH' in env:
-        env.PrependENVPath('LD_LIBRARY_PATH', env['LD_LIBRARY_PATH'])
+    # Import the host environment variables that processes launched by scons need:
+    # - ARMLMD_LICENSE_FILE for licensed tools.
+    # - TERM allows colours to be used e.g. for errors.
+    # - PROCESSOR_ARCHITECTURE allows processes to detect the processor architecture.
+    # - PYTHONUNBUFFERED allows python processes to honour it.
+    #   I think a better way of handling this would be to have each script set this itself
+    #   if that script is launching subprocesses, but I haven't found a good way of doing this.
+    # - CCACHE_DIR allows ccache (see the use_ccache option) to find its cache.
+    env_vars = env['ENV']
+    for name in _IMPORTED_ENV_VARS:
+        value = os.environ.get(name)
+        if value is not None:
+            env_vars[name] = value
+    # Prepend to the PATH and LD_LIBRARY_PATH env additional paths to search when executing through scons
+    for name in ('PATH', 'LD_LIBRARY_PATH'):
+        if name in env:
+            env.PrependENVPath(name, env[name])
     # Because these path arguments may be relative, they must be correctly interpreted as relative to the top-level
     # folder rather than the 'build' subdirectory, which is what scons would do if they were passed to the SConscript
     # as-is. Therefore we convert them to absolute paths here, where they will be interpreted correctly.
+    # The working directory is looked up once, rather than by each os.path.abspath call.
+    cwd = os.getcwd()
+    # Empty entries (e.g. from a trailing separator) are skipped, and duplicates removed before passing to scons.
     if 'CPATH' in env:
-        env.AppendUnique(CPPPATH=[os.path.abspath(x) for x in env['CPATH'].split(os.pathsep)])
+        env.AppendUnique(CPPPATH=list(dict.fromkeys(
+            os.path.normpath(os.path.join(cwd, x)) for x in env['CPATH'].split(os.pathsep) if x)))
     if 'LPATH' in env:
-        env.AppendUnique(LIBPATH=[os.path.abspath(x) for x in env['LPATH'].split(os.pathsep)])
+        env.AppendUnique(LIBPATH=list(dict.fromkeys(
+            os.path.normpath(os.path.join(cwd, x)) for x in env['LPATH'].split(os.pathsep) if x)))
+    if env.get('scons_cache_dir'):
+        env['scons_cache_dir'] = os.path.normpath(os.path.join(cwd, env['scons_cache_dir']))
 
 
 def setup_common_env(env):
@@ -118,24 +152,24 @@ def setup_common_env(env):
     '''
     # Secure Development Lifecycle
     # The following is a set of security compilation flags required
-    env.AppendUnique(CPPFLAGS=['-Wall', '-Wextra'])
+    # The flags are gathered up and added to the environment at the end, so that scons only has to merge them once.
+    cppflags = ['-Wall', '-Wextra']
     if env['werror']:
-        env.AppendUnique(CPPFLAGS=['-Werror'])
+        cppflags.append('-Werror')
     # Increase the warning level for 'format' to 2, but disable the nonliteral case
-    env.AppendUnique(CPPFLAGS=['-Wformat=2', '-Wno-format-nonliteral'])
-    env.AppendUnique(CPPFLAGS=['-Wctor-dtor-privacy', '-Woverloaded-virtual', '-Wsign-promo', '-Wstrict-overflow=2',
-                               '-Wswitch-default', '-Wlogical-op', '-Wnoexcept', '-Wstrict-null-sentinel',
-                               '-Wconversion'])
+    cppflags += ['-Wformat=2', '-Wno-format-nonliteral']
+    cppflags += ['-Wctor-dtor-privacy', '-Woverloaded-virtual', '-Wsign-promo', '-Wstrict-overflow=2',
+                 '-Wswitch-default', '-Wlogical-op', '-Wnoexcept', '-Wstrict-null-sentinel', '-Wconversion']
     # List of flags that should be set but currently fail
-    # env.AppendUnique(CPPFLAGS=['-Weffc++'])
-    # env.AppendUnique(CPPFLAGS=['-pedantic', '-fstack-protector-strong'])
+    # cppflags += ['-Weffc++']
+    # cppflags += ['-pedantic', '-fstack-protector-strong']
 
-    env.AppendUnique(CPPFLAGS=['-fPIC'])
-    env.AppendUnique(CXXFLAGS=['-std=c++14'])
+    cppflags.append('-fPIC')
+    cxxflags = ['-std=c++14']
     if env['debug']:
-        env.AppendUnique(CXXFLAGS=['-O0', '-g'])
+        cxxflags += ['-O0', '-g']
     else:
-        env.AppendUnique(CXXFLAGS=['-O3'])
+        cxxflags.append('-O3')
     env.PrependUnique(CPPPATH=['include'])
 
     # Setup asserts, if asserts are explicitly set then set NDEBUG accordingly.
@@ -143,11 +177,12 @@ def setup_common_env(env):
     if env['asserts'] == '0' or (env['asserts'] == 'debug' and not env['debug']):
         env.AppendUnique(CPPDEFINES=['NDEBUG'])
 
+    linkflags = []
     if env.get('coverage', False):
-        env.AppendUnique(CXXFLAGS=['--coverage', '-O0'])
-        env.AppendUnique(LINKFLAGS=['--coverage'])
+        cxxflags += ['--coverage', '-O0']
+        linkflags.append('--coverage')
     # By enabling this flag, binary will use RUNPATH instead of RPATH
-    env.AppendUnique(LINKFLAGS=["-Wl,--enable-new-dtags"])
+    linkflags.append('-Wl,--enable-new-dtags')
 
     # Add sanitization flags
     if env['sanitize']:
@@ -157,9 +192,15 @@ def setup_common_env(env):
             '-fsanitize=undefined',
             '-fsanitize=leak'
         )
-        env.AppendUnique(CXXFLAGS=flags)
-        env.AppendUnique(CPPFLAGS=flags)
-        env.AppendUnique(LINKFLAGS=flags)
+        cxxflags += flags
+        cppflags += flags
+        linkflags += flags
+
+    env.AppendUnique(CPPFLAGS=cppflags, CXXFLAGS=cxxflags, LINKFLAGS=linkflags)
+
+    # Retrieve unchanged build outputs from the shared cache rather than rebuilding them
+    if env.get('scons_cache_dir'):
+        env.CacheDir(env['scons_cache_dir'])
 
 
 def setup_toolchain(env, toolchain):
@@ -170,6 +211,7 @@ def setup_toolchain(env, toolchain):
         env (SCons.Environment): The scons environment to use
         toolchain         (str): One of the following strings are accepted ('aarch64', 'armclang', 'native')
                                  Any other value defaults to the same as native
+    If the use_ccache option is set then the selected compilers are invoked through ccache.
     '''
     if toolchain == 'aarch64':
         env.Replace(CC='aarch64-linux-gnu-gcc',
@@ -185,6 +227,27 @@ def setup_toolchain(env, toolchain):
                     AS='armclang --target=arm-arm-none-eabi',
                     AR='armar',
                     RANLIB='armar -s')
+        # armclang is commonly installed as a wrapper, so have ccache identify the compiler by its content
+        # rather than by its mtime and size.
+        env['ENV']['CCACHE_COMPILERCHECK'] = 'content'
+
+    if env.get('use_ccache') and env.WhereIs('ccache'):
+        env['CC'] = 'ccache ' + env['CC']
+        env['CXX'] = 'ccache ' + env['CXX']
+
+
+# Directories which have already been found to exist. Failed lookups are not cached, as the directory may be
+# created later in the build.
+_known_dirs = set()
+
+
+def _is_dir(path):
+    path = os.path.abspath(path)
+    if path not in _known_dirs:
+        if not os.path.isdir(path):
+            return False
+        _known_dirs.add(path)
+    return True
 
 
 def validate_dir(env, path, exception_type):
@@ -199,7 +262,7 @@ def validate_dir(env, path, exception_type):
         path                            (str): The scons parameter to validate
         exception_type (exceptions.Exception): The exception type to throw in the event of an invalid path
     '''
-    if not os.path.isdir(env[path]):
+    if not _is_dir(env[path]):
         raise exception_type('\033[91mERROR: {} is not a valid directory.\033[0m'.format(path))
 
 
@@ -214,9 +277,12 @@ def parse_int(env, variable, exception_type):
         variable                        (str): The scons parameter to validate
         exception_type (exceptions.Exception): The exception type to throw in the event of an invalid variable
     '''
+    value = env.get(variable)
+    if isinstance(value, int):
+        return
     try:
-        env[variable] = int(env[variable])
-    except:
+        env[variable] = int(value)
+    except (TypeError, ValueError):
         raise exception_type('\033[91mERROR: {} is not a valid value.\033[0m'.format(variable))
 
 
@@ -235,24 +301,46 @@ def variable_exists(env, variable, exception_type):
         raise exception_type('\033[91mERROR: Missing required "{}" parameter.\033[0m'.format(variable))
 
 
-def abs_path(env, paths, relative_offset='.'):
+def _abs_paths(env, paths, relative_offset, resolve):
     '''
-    Convert path(s) to their absolute path equivalent.
+    Shared implementation of abs_path() and abs_filepath().
 
     Args:
         env   (SCons.Environment): The scons environment to use
-        paths (str or list/tuple): The scons parameter(s) to abspath
+        paths (str or list/tuple): The scons parameter(s) to convert
         relative_offset (str)    : When a relative path needs converting to absolute, it is interpreted relative to this
+        resolve        (function): Converts the joined absolute path into the final value
     '''
     paths = paths if isinstance(paths, (list, tuple)) else [paths]
+    # Only resolve relative_offset through the scons node tree once, and only if it is needed
+    offset_dir = None
     for path in paths:
+        if path not in env:
+            continue
+        value = env[path]
+        if os.path.isabs(value):
+            continue
+        if offset_dir is None:
+            offset_dir = env.Dir(relative_offset).abspath
         try:
-            if not os.path.isabs(env[path]):
-                env[path] = env.Dir(os.path.join(relative_offset, env[path])).abspath
-        except KeyError:
+            env[path] = resolve(os.path.join(offset_dir, value))
+        except TypeError:
+            # If path to file is not given, SCons assumes that value is '.', which is a directory
             continue
 
 
+def abs_path(env, paths, relative_offset='.'):
+    '''
+    Convert path(s) to their absolute path equivalent.
+
+    Args:
+        env   (SCons.Environment): The scons environment to use
+        paths (str or list/tuple): The scons parameter(s) to abspath
+        relative_offset (str)    : When a relative path needs converting to absolute, it is interpreted relative to this
+    '''
+    _abs_paths(env, paths, relative_offset, os.path.normpath)
+
+
 def abs_filepath(env, paths, relative_offset='.'):
     '''
     Convert file path(s) to their absolute file path equivalent.
@@ -262,26 +350,27 @@ def abs_filepath(env, paths, relative_offset='.'):
         paths (str or list/tuple): The scons parameter(s) to conviert into absolute file path
         relative_offset (str)    : When a relative path needs converting to absolute, it is interpreted relative to this
     '''
-    paths = paths if isinstance(paths, (list, tuple)) else [paths]
-    for path in paths:
-        try:
-            if not os.path.isabs(env[path]):
-                env[path] = env.File(os.path.join(relative_offset, env[path])).abspath
-        except KeyError:
-            continue
-        except TypeError:
-            # If path to file is not given, SCons assumes that value is '.', which is a directory
-            continue
+    _abs_paths(env, paths, relative_offset, lambda p: env.File(p).abspath)
 
 
 def get_build_type(env):
     return 'debug' if env['debug'] else 'release'
 
 
+# Absolute build directories resolved so far, keyed by the unresolved path
+_build_dir_cache = {}
+
+
 def get_build_dir(env, module_base, config=None):
     if config is None:
         config = '{}_{}'.format(get_build_type(env), env['platform'])
-    return env.Dir(os.path.join(module_base, env['build_dir'], config)).abspath
+    path = os.path.join(module_base, env['build_dir'], config)
+    # Relative paths are resolved against the SConscript currently being read, so only absolute ones are cached
+    if not os.path.isabs(path):
+        return env.Dir(path).abspath
+    if path not in _build_dir_cache:
+        _build_dir_cache[path] = env.Dir(path).abspath
+    return _build_dir_cache[path]
 
 
 def get_driver_library_build_dir(env):
@@ -312,6 +401,7 @@ def get_single_elem(elems, msg_context):
     return elems[0]
 
 
+@functools.lru_cache(maxsize=None)
 def root_dir():
     "Returns the root of driver_stack tree"
     return os.path.realpath(os.path.join(__file__, '..', '..'))
@@ -322,10 +412,11 @@ def add_padding(align):
     Return a function that can be used in a Command target to pad a file to a multiple of align bytes in place.
     '''
     def add_padding_fn(env, source, target):
-        with open(target[0].path, 'ab') as f:
-            sz = f.tell()
-            new_sz = ((sz + align - 1) // align) * align
-            f.write(b'\x00' * (new_sz - sz))
+        sz = os.path.getsize(target[0].path)
+        new_sz = -(-sz // align) * align
+        # Extending the file zero-fills it, without having to build and write the padding ourselves
+        if new_sz != sz:
+            os.truncate(target[0].path, new_sz)
     return add_padding_fn
 
 